@@ -0,0 +1,137 @@
+"""
+ Implements admission control: per-user rate limits and a global concurrency limit.
+
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Takes a token, returns 0 if admitted or the seconds until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        """Returns if the bucket refilled completely, so it is like a new one."""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class ConcurrencyLimiter:
+    """Bounds the requests in flight, with a bounded queue of waiting requests."""
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    def acquire(self):
+        """Takes a slot, waiting in the queue if there is room, returns if it got one."""
+        if self.slots.acquire(blocking=False):
+            return True
+
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout=self.timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        """Gives back a slot."""
+        self.slots.release()
+
+
+class AdmissionControl:
+    """Admits or sheds requests, counting the shed ones."""
+
+    def __init__(self, rates, concurrency, queue_size, queue_timeout, sweep_interval=60):
+        self.rates = rates
+        self.concurrency = ConcurrencyLimiter(concurrency, queue_size, queue_timeout)
+        self.buckets = {}
+        self.shed = {}
+        self.lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.swept = time.monotonic()
+
+    def admit_user(self, user_id, kind):
+        """Charges a request of the kind ("read" or "write") to the user.
+
+        Returns 0 if admitted, or the seconds until the user can retry.
+        """
+        key = (str(user_id), kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, TokenBucket(*self.rates[kind]))
+
+        retry_after = bucket.take()
+        if retry_after:
+            self.count(f"rate_limited_{kind}")
+
+        if time.monotonic() - self.swept >= self.sweep_interval:
+            self.sweep()
+        return retry_after
+
+    def sweep(self):
+        """Drops the buckets that refilled, a new one is created on the next request."""
+        with self.lock:
+            now = time.monotonic()
+            self.swept = now
+            for key, bucket in list(self.buckets.items()):
+                if bucket.idle(now):
+                    del self.buckets[key]
+
+    def enter(self):
+        """Takes a concurrency slot for a request, returns if it was admitted."""
+        if self.concurrency.acquire():
+            return True
+        self.count("overloaded")
+        return False
+
+    def leave(self):
+        """Gives back the concurrency slot of a request."""
+        self.concurrency.release()
+
+    def count(self, reason):
+        """Counts a shed request."""
+        with self.lock:
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def metrics(self):
+        """Returns the shed counts and the current load."""
+        with self.lock:
+            shed = dict(self.shed)
+        return {
+            "shed": shed,
+            "waiting": self.concurrency.waiting,
+        }
+
+    def reset(self):
+        """Forgets every bucket and shed count."""
+        with self.lock:
+            self.buckets.clear()
+            self.shed.clear()
+            self.swept = time.monotonic()
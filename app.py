@@ -4,11 +4,23 @@
 """
 
 import os
-from flask import Flask, request, jsonify, make_response
-from flask_restful import Resource, Api, reqparse, abort
+import hmac
+import json
+import math
+import urllib.error
+import urllib.request
+import click
+from typing import Callable
+from flask import Flask, Response, g, request, jsonify, make_response
+from flask_restful import Resource, Api, abort
+from werkzeug.exceptions import HTTPException
 # https://flask-restful.readthedocs.io/en/latest/quickstart.html
 
-from models import Database
+from models import Database, Shard, ShardRouter
+from events import EventHub, format_event
+from admission import AdmissionControl
+from assets import StaticAssets
+from archive import Archiver
 
 
 
@@ -20,9 +32,65 @@ IS_DEVELOPMENT = False
 #  Database
 # ==========
 
-# Creates an sqlite database in memory
-db = Database(filename=':memory:', schema=f'{os.getcwd()}{"/schema.sql" if IS_DEVELOPMENT else "/CPD_T3/schema.sql"}')
-db.recreate()
+SCHEMA_DIR = f'{os.getcwd()}{"" if IS_DEVELOPMENT else "/CPD_T3"}'
+
+# Shard databases, the projects and tasks of each user live in one of them
+SHARD_FILES = [':memory:'] * 4
+
+# Creates the sqlite databases in memory, a directory with the users and the shards
+shards = ShardRouter(
+    directory=Database(filename=':memory:', schema=f'{SCHEMA_DIR}/schema.sql'),
+    shard_files=SHARD_FILES,
+    shard_schema=f'{SCHEMA_DIR}/schema_shard.sql',
+    seed=f'{SCHEMA_DIR}/seed.sql',
+)
+shards.recreate()
+
+# Completed tasks are archived after these days, in batches, checked every interval in seconds
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_INTERVAL = 60
+
+# Keeps the task tables down to the working set, moving the old completed tasks to the archive
+archiver = Archiver(shards, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_INTERVAL)
+archiver.start()
+
+
+
+# ===============
+#  Change events
+# ===============
+
+# Seconds between keep-alive comments on an idle event stream
+EVENTS_KEEPALIVE = 15
+
+# Milliseconds a disconnected client waits before reconnecting, sent as the first line of the stream
+EVENTS_RETRY = 3000
+
+# Fans out project and task changes to the event streams of each user
+hub = EventHub(history=256, queue_size=64)
+
+
+
+# ===================
+#  Admission control
+# ===================
+
+# Requests per second and burst allowed to each user, per kind of request
+RATE_LIMITS = { "read": (20, 60), "write": (5, 20) }
+
+# Requests handled at once, and how many may wait for a slot and for how many seconds
+CONCURRENCY_LIMIT = 16
+CONCURRENCY_QUEUE = 32
+CONCURRENCY_TIMEOUT = 2
+
+# Endpoints not holding a concurrency slot, long lived streams and the metrics
+ADMISSION_EXEMPT = { "apievents", "apimetrics" }
+
+# Token for the operator endpoints, sent on the X-Admin-Token header, they are disabled without it
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+admission = AdmissionControl(RATE_LIMITS, CONCURRENCY_LIMIT, CONCURRENCY_QUEUE, CONCURRENCY_TIMEOUT)
 
 
 
@@ -30,7 +98,8 @@ db.recreate()
 #  Settings
 # ==========
 
-app = Flask(__name__)
+# The static files are served from memory by the web views
+app = Flask(__name__, static_folder=None)
 app.config['STATIC_URL_PATH'] = '/static'
 app.config['DEBUG'] = True
 
@@ -42,13 +111,41 @@ api = Api(app)
 #  Web views
 # ===========
 
+# Loads the static files once, with content hashed names and gzip variants
+assets = StaticAssets(os.path.join(app.root_path, 'static'), url_path=app.config['STATIC_URL_PATH'])
+
+def send_asset(name: str):
+    """ Returns a static file from memory, compressed if the client accepts it """
+    asset = assets.get(name)
+    if not asset:
+        abort(HTTP_CODES["NotFound"], message="Non existent file")
+
+    compressed = asset.gzip is not None and request.accept_encodings["gzip"] > 0
+    response = make_response(asset.gzip if compressed else asset.data)
+    response.mimetype = asset.mimetype
+    response.headers["Vary"] = "Accept-Encoding"
+    if compressed:
+        response.headers["Content-Encoding"] = "gzip"
+
+    # Hashed names are cached for good, the rest are revalidated with their ETag
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable" if assets.is_immutable(name) else "no-cache"
+    response.set_etag(f'{asset.etag}{"-gzip" if compressed else ""}')
+    return response.make_conditional(request)
+
 class WebViewIndex(Resource):
     """ Returns the web page """
     def get(self):
         """ Returns the web page """
-        return app.send_static_file('index.html')
+        return send_asset('index.html')
 api.add_resource(WebViewIndex, "/")
 
+class WebViewStatic(Resource):
+    """ Returns the static files """
+    def get(self, filename):
+        """ Returns a static file """
+        return send_asset(filename)
+api.add_resource(WebViewStatic, f"{app.config['STATIC_URL_PATH']}/<path:filename>")
+
 
 
 # ===========
@@ -60,23 +157,71 @@ HTTP_CODES = {
     "Unauthorized": 401,
     "Forbidden": 403,
     "NotFound": 404,
+    "TooManyRequests": 429,
+    "ServiceUnavailable": 503,
 }
 
-class ApiBodyParser(reqparse.RequestParser):
-    """ Class to parse the Request Body arguments """
-    def __init__(self, *arguments: str | tuple[str, bool]):
-        super().__init__()
-
-        # iterate over the arguments and add it
-        for argument in arguments:
-            if isinstance(argument, tuple):
-                self.add_argument(argument[0], required=argument[1])
-            else:
-                self.add_argument(argument)
+def shed(code: int, message: str, retry_after: float):
+    """ Rejects the request right away, telling the client when to retry """
+    response = make_response(jsonify({ "message": message }), code)
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    raise HTTPException(response=response)
+
+def body_text(value) -> str:
+    """ Coerce a body value to text """
+    return str(value)
+
+def body_flag(value) -> int:
+    """ Coerce a body value to a boolean flag, stored as 0 or 1 """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int) and value in (0, 1):
+        return value
+    if isinstance(value, str) and value.lower() in ("0", "1", "false", "true"):
+        return int(value.lower() in ("1", "true"))
+    raise ValueError("not a boolean")
+
+def body_index(value) -> int:
+    """ Coerce a body value to a non negative integer """
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    raise ValueError("not a non negative integer")
+
+class ApiBodySchema():
+    """ Schema of a Request Body, built once and used to parse every request """
+
+    def __init__(self, *arguments: str | tuple[str, bool] | tuple[str, bool, Callable]):
+        # Compile the arguments into (name, required, coerce) tuples
+        self.arguments = tuple(
+            (argument, False, body_text) if isinstance(argument, str) else (argument + (body_text,))[:3]
+            for argument in arguments
+        )
 
     def parse(self) -> dict[str, str | int]:
-        """ Parse the request body and return a dict with all the properties """
-        return super().parse_args()
+        """ Parse the JSON request body and return a dict with all the properties """
+
+        # The JSON body is decoded once and cached on the request
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            body = {}
+
+        # Validate and coerce each argument, missing ones are None
+        parsed = {}
+        for name, required, coerce in self.arguments:
+            value = body.get(name)
+            if value is None:
+                if required:
+                    abort(HTTP_CODES["BadRequest"], message={ name: "Missing required parameter in the JSON body" })
+                parsed[name] = None
+                continue
+            try:
+                parsed[name] = coerce(value)
+            except (TypeError, ValueError) as error:
+                abort(HTTP_CODES["BadRequest"], message={ name: f"Invalid value: {error}" })
+
+        return parsed
 
 
 
@@ -106,6 +251,10 @@ class ApiUserAuth():
     def id(self) -> str:
         """ Get found id """
         return self["__id__"]
+    @property
+    def db(self) -> Shard:
+        """ Get the shard with the user projects and tasks """
+        return self["__db__"]
 
     def validate(self):
         """ Validates if the user is authorized """
@@ -115,7 +264,7 @@ class ApiUserAuth():
             abort(HTTP_CODES["Forbidden"], message="No present authorization")
 
         # Get the user data from the BD
-        user_data = db.execute_query("SELECT id FROM user WHERE username=? AND password=?", (
+        user_data = shards.directory.execute_query("SELECT id FROM user WHERE username=? AND password=?", (
             self["username"], self["password"]
         )).fetchone()
 
@@ -125,10 +274,64 @@ class ApiUserAuth():
 
         # Set the id inside this object
         setattr(self, "__id__", str(user_data["id"]))
+
+        # Charge the request to the user rate limit, once even if validated again
+        if not g.get("rate_limited"):
+            g.rate_limited = True
+            kind = "read" if request.method in ("GET", "HEAD", "OPTIONS") else "write"
+            retry_after = admission.admit_user(self["id"], kind)
+            if retry_after:
+                shed(HTTP_CODES["TooManyRequests"], "Too many requests", retry_after)
+
+        # Keep the user on their shard until the request ends, it can not be moved in between
+        if "shard" not in g:
+            shard = shards.acquire(self["id"])
+            if not shard:
+                shed(HTTP_CODES["ServiceUnavailable"], "User data being moved", 1)
+            g.shard_user, g.shard = self["id"], shard
+
+        # Set the shard inside this object
+        setattr(self, "__db__", g.shard)
         return self
 
 
 
+
+class ApiAdminAuth():
+    """ Operator authorization validator """
+
+    def validate(self):
+        """ Validates if the request has the admin token """
+        token = request.headers.get("X-Admin-Token", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            abort(HTTP_CODES["Forbidden"], message="Invalid admin token")
+        return self
+
+
+
+@app.before_request
+def admission_enter():
+    """ Takes a concurrency slot for the request, or sheds it if the server is overloaded """
+    if request.endpoint in ADMISSION_EXEMPT:
+        return
+    if not admission.enter():
+        shed(HTTP_CODES["ServiceUnavailable"], "Server overloaded", CONCURRENCY_TIMEOUT)
+    g.admitted = True
+
+@app.teardown_request
+def admission_leave(error):
+    """ Gives back the concurrency slot of the request """
+    if g.pop("admitted", False):
+        admission.leave()
+
+@app.teardown_request
+def shard_release(error):
+    """ Lets the user of the request be moved to another shard again """
+    if "shard_user" in g:
+        shards.release(g.pop("shard_user"))
+
+
+
 # ===========
 #  API views
 # ===========
@@ -136,20 +339,25 @@ class ApiUserAuth():
 class ApiUserRegister(Resource):
     """ Register endpoint """
 
+    post_body = ApiBodySchema(("name", True), ("email", True), ("username", True), ("password", True))
+
     def post(self):
         """ Post to register a new user """
 
-        # Build the parser for this endpoint, and parse the request body
-        request_body = ApiBodyParser(("name", True), ("email", True), ("username", True), ("password", True)).parse()
+        # Parse the request body with the schema of this endpoint
+        request_body = self.post_body.parse()
 
         # Execute SQL query to insert a new user
-        new_user_id = str(db.execute_update("INSERT INTO user VALUES (null, ?, ?, ?, ?)", (
+        new_user_id = str(shards.directory.execute_update("INSERT INTO user VALUES (null, ?, ?, ?, ?)", (
             request_body["name"], request_body['email'], request_body["username"], request_body["password"]
         )))
 
+        # Assign the new user to a shard for their projects and tasks
+        shards.assign(new_user_id)
+
         # get the just inserted user
-        user_data = db.execute_query("SELECT * FROM user WHERE id=?", (
-            new_user_id
+        user_data = shards.directory.execute_query("SELECT * FROM user WHERE id=?", (
+            new_user_id,
         )).fetchone()
 
         return make_response(jsonify(user_data))
@@ -160,14 +368,16 @@ api.add_resource(ApiUserRegister, "/api/user/register")
 class ApiUserLogin(Resource):
     """ Login endpoint """
 
+    post_body = ApiBodySchema(("username", True), ("password", True))
+
     def post(self):
         """ Post saying if is a valid login """
 
         # Parse the body and validates if all arguments are setted
-        request_body = ApiBodyParser(("username", True), ("password", True)).parse()
+        request_body = self.post_body.parse()
 
         # Get the user data from the BD
-        user_data = db.execute_query("SELECT * FROM user WHERE username=? AND password=?", (
+        user_data = shards.directory.execute_query("SELECT * FROM user WHERE username=? AND password=?", (
             request_body["username"], request_body["password"]
         )).fetchone()
 
@@ -183,6 +393,8 @@ api.add_resource(ApiUserLogin, "/api/user/login")
 class ApiUser(Resource):
     """ User endpoints """
 
+    put_body = ApiBodySchema("username", "email", "password", "name")
+
     def get(self):
         """ Return current user """
 
@@ -190,8 +402,8 @@ class ApiUser(Resource):
         user_auth = ApiUserAuth().validate()
 
         # Get the user data from the BD
-        user_data = db.execute_query("SELECT * FROM user WHERE id=?", (
-            user_auth["id"]
+        user_data = shards.directory.execute_query("SELECT * FROM user WHERE id=?", (
+            user_auth["id"],
         )).fetchone()
 
         return make_response(jsonify(user_data))
@@ -203,16 +415,16 @@ class ApiUser(Resource):
         user_data: dict[str, str] = ApiUser().get().get_json()
 
         # Parse the body and validates
-        request_body = ApiBodyParser("username", "email", "password", "name").parse()
+        request_body = self.put_body.parse()
 
         # Iterate over request body and replace the data with the wanted to edit to
         for argument in request_body:
-            if not request_body[argument]:
+            if request_body[argument] in (None, ""):
                 continue
             user_data[argument] = request_body[argument]
 
         # Execute SQL query to update this user
-        db.execute_update("UPDATE user SET name = ?, email = ?, username = ?, password = ? WHERE id = ?;", (
+        shards.directory.execute_update("UPDATE user SET name = ?, email = ?, username = ?, password = ? WHERE id = ?;", (
             user_data["name"], user_data['email'], user_data["username"], user_data["password"], user_data["id"]
         ))
 
@@ -225,6 +437,8 @@ api.add_resource(ApiUser, "/api/user")
 class ApiProject(Resource):
     """ Projects endpoints """
 
+    post_body = ApiBodySchema(("title", True), "creation_date", "last_updated")
+
     def get(self):
         """ Get all projects """
 
@@ -232,8 +446,8 @@ class ApiProject(Resource):
         user_auth = ApiUserAuth().validate()
 
         # Get all the projects from the DB
-        user_projects = db.execute_query("SELECT * FROM project WHERE user_id=?", (
-            user_auth["id"]
+        user_projects = user_auth.db.execute_query("SELECT * FROM project WHERE user_id=?", (
+            user_auth["id"],
         )).fetchall()
 
         return make_response(jsonify(user_projects))
@@ -245,15 +459,18 @@ class ApiProject(Resource):
         user_auth = ApiUserAuth().validate()
 
         # Parse the body and validates
-        request_body = ApiBodyParser(("title", True), "creation_date", "last_updated").parse()
+        request_body = self.post_body.parse()
 
-        # Execute SQL query to insert a new project
-        new_project_id = str(db.execute_update("INSERT INTO project VALUES (null, ?, ?, ?, ?)", (
-            user_auth["id"], request_body['title'], request_body["creation_date"], request_body["last_updated"]
-        )))
+        # Execute SQL query to insert a new project, with an id from its shard
+        new_project_id = user_auth.db.next_id("project")
+        user_auth.db.execute_update("INSERT INTO project (id, user_id, title, creation_date, last_updated) VALUES (?, ?, ?, ?, ?)", (
+            new_project_id, user_auth["id"], request_body['title'], request_body["creation_date"], request_body["last_updated"]
+        ))
 
         # get the just inserted project
-        user_project = db.execute_query("SELECT * FROM project WHERE id=?", (new_project_id)).fetchone()
+        user_project = user_auth.db.execute_query("SELECT * FROM project WHERE id=?", (new_project_id,)).fetchone()
+
+        hub.publish(user_auth["id"], "insert", "project", user_project)
 
         return make_response(jsonify(user_project))
 api.add_resource(ApiProject, "/api/projects")
@@ -263,6 +480,8 @@ api.add_resource(ApiProject, "/api/projects")
 class ApiProjectDetails(Resource):
     """ Single project endpoints """
 
+    put_body = ApiBodySchema("title", "creation_date", "last_updated")
+
     def get(self, project):
         """ Get details from project """
 
@@ -270,7 +489,7 @@ class ApiProjectDetails(Resource):
         user_auth = ApiUserAuth().validate()
 
         # Get the project
-        user_project = db.execute_query("SELECT * FROM project WHERE id=? AND user_id=?", (
+        user_project = user_auth.db.execute_query("SELECT * FROM project WHERE id=? AND user_id=?", (
             project, user_auth["id"]
         )).fetchone()
 
@@ -283,37 +502,52 @@ class ApiProjectDetails(Resource):
     def put(self, project):
         """ Update details of project """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the project
         user_project: dict[str, str] = ApiProjectDetails().get(project).get_json()
 
         # Parse the body and validates
-        request_body = ApiBodyParser("title", "creation_date", "last_updated").parse()
+        request_body = self.put_body.parse()
 
         # Iterate over request body and replace the data with the wanted to edit to
         for argument in request_body:
-            if not request_body[argument]:
+            if request_body[argument] in (None, ""):
                 continue
             user_project[argument] = request_body[argument]
 
         # Execute SQL query to update the project on the DB
-        db.execute_update("UPDATE project SET title = ?, creation_date = ?, last_updated = ? WHERE id = ?;", (
+        user_auth.db.execute_update("UPDATE project SET title = ?, creation_date = ?, last_updated = ? WHERE id = ?;", (
             user_project["title"], user_project['creation_date'], user_project["last_updated"], user_project["id"]
         ))
 
+        # Get the new change version of the project
+        user_project["version"] = user_auth.db.execute_query("SELECT version FROM project WHERE id=?", (
+            user_project["id"],
+        )).fetchone()["version"]
+
+        hub.publish(user_project["user_id"], "update", "project", user_project)
+
         # Return the overwritten data
         return make_response(jsonify(user_project))
 
     def delete(self, project):
         """ Delete project """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the project
-        ApiProjectDetails().get(project).get_json()
+        user_project = ApiProjectDetails().get(project).get_json()
 
         # Execute SQL query to delete project from DB
-        db.execute_update("DELETE FROM project WHERE id = ?;", (
-            project
+        user_auth.db.execute_update("DELETE FROM project WHERE id = ?;", (
+            project,
         ))
 
+        hub.publish(user_project["user_id"], "delete", "project", user_project)
+
         return make_response(jsonify({ "deleted": True }))
 api.add_resource(ApiProjectDetails, "/api/projects/<string:project>")
 
@@ -322,6 +556,8 @@ api.add_resource(ApiProjectDetails, "/api/projects/<string:project>")
 class ApiTask(Resource):
     """ Tasks endpoints """
 
+    post_body = ApiBodySchema(("title", True), "creation_date", ("completed", False, body_flag))
+
     def get(self, project):
         """ Get tasks list """
 
@@ -332,31 +568,43 @@ class ApiTask(Resource):
         ApiProjectDetails().get(project).get_json()
 
         # Get all the tasks from the DB
-        user_tasks = db.execute_query("SELECT task.* FROM project INNER JOIN task ON project.id = task.project_id WHERE project.id = ? AND project.user_id = ?", (
+        user_tasks = user_auth.db.execute_query("SELECT task.* FROM project INNER JOIN task ON project.id = task.project_id WHERE project.id = ? AND project.user_id = ?", (
             project, user_auth["id"]
         )).fetchall()
 
+        # Get the archived tasks too, only when asked for
+        if request.args.get("include_archived") == "true":
+            user_tasks += user_auth.db.execute_query("SELECT task_archive.* FROM project INNER JOIN task_archive ON project.id = task_archive.project_id WHERE project.id = ? AND project.user_id = ?", (
+                project, user_auth["id"]
+            )).fetchall()
+
         return make_response(jsonify(user_tasks))
 
     def post(self, project):
         """ Post new task """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the project
-        ApiProjectDetails().get(project).get_json()
+        user_project = ApiProjectDetails().get(project).get_json()
 
         # Parse the body and validates
-        request_body = ApiBodyParser(("title", True), "creation_date", "completed").parse()
+        request_body = self.post_body.parse()
 
-        # Execute SQL query to insert a new task on the DB
-        new_task_id = str(db.execute_update("INSERT INTO task VALUES (null, ?, ?, ?, ?)", (
-            project, request_body['title'], request_body["creation_date"], request_body["completed"]
-        )))
+        # Execute SQL query to insert a new task on the DB, with an id from its shard
+        new_task_id = user_auth.db.next_id("task")
+        user_auth.db.execute_update("INSERT INTO task (id, project_id, title, creation_date, completed) VALUES (?, ?, ?, ?, ?)", (
+            new_task_id, project, request_body['title'], request_body["creation_date"], request_body["completed"]
+        ))
 
         # get the just inserted task
-        user_task = db.execute_query("SELECT * FROM task WHERE id=?", (
-            new_task_id
+        user_task = user_auth.db.execute_query("SELECT * FROM task WHERE id=?", (
+            new_task_id,
         )).fetchone()
 
+        hub.publish(user_project["user_id"], "insert", "task", user_task)
+
         return make_response(jsonify(user_task))
 api.add_resource(ApiTask, "/api/projects/<string:project>/tasks")
 
@@ -365,14 +613,21 @@ api.add_resource(ApiTask, "/api/projects/<string:project>/tasks")
 class ApiTaskDetails(Resource):
     """ Single task endpoints """
 
+    put_body = ApiBodySchema("title", "creation_date", ("completed", False, body_flag))
+
     def get(self, project, task):
         """ Get details from task """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the project
         ApiProjectDetails().get(project).get_json()
 
-        # Get the task from the DB
-        user_task = db.execute_query("SELECT * FROM task WHERE id=? AND project_id=?", (
+        # Get the task from the DB, or from the archive if it was archived
+        user_task = user_auth.db.execute_query("SELECT * FROM task WHERE id=? AND project_id=?", (
+            task, project
+        )).fetchone() or user_auth.db.execute_query("SELECT * FROM task_archive WHERE id=? AND project_id=?", (
             task, project
         )).fetchone()
 
@@ -385,42 +640,268 @@ class ApiTaskDetails(Resource):
     def put(self, project, task):
         """ Update details from task """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the task
         user_task: dict[str, str] = ApiTaskDetails().get(project, task).get_json()
 
         # Parse the body
-        request_body = ApiBodyParser("title", "creation_date", "completed").parse()
+        request_body = self.put_body.parse()
 
         # Iterate over request body and replace the data with the wanted to edit to
         for argument in request_body:
-            if not request_body[argument]:
+            if request_body[argument] in (None, ""):
                 continue
             user_task[argument] = request_body[argument]
 
-        # Execute SQL query to update the task on the DB
-        db.execute_update("UPDATE task SET title = ?, creation_date = ?, completed = ? WHERE id = ?;", (
-            user_task["title"], user_task['creation_date'], user_task["completed"], user_task["id"]
-        ))
+        # Hold the shard so the archiver cannot move the task until it is updated
+        with user_auth.db.lock:
+            # Move the task back from the archive, if it is or just got archived
+            user_auth.db.unarchive_task(user_task["id"])
 
-        # Return the overwritten data
+            # Execute SQL query to update the task on the DB
+            user_auth.db.execute_update("UPDATE task SET title = ?, creation_date = ?, completed = ? WHERE id = ?;", (
+                user_task["title"], user_task['creation_date'], user_task["completed"], user_task["id"]
+            ))
+
+            # Get the updated task, with the version and completion time set by the DB
+            user_task = user_auth.db.execute_query("SELECT * FROM task WHERE id=?", (
+                user_task["id"],
+            )).fetchone()
+
+        # Verify it was not deleted meanwhile
+        if not user_task:
+            abort(HTTP_CODES["NotFound"], message="Non existent task")
+
+        hub.publish(user_auth["id"], "update", "task", user_task)
+
+        # Return the updated data
         return make_response(jsonify(user_task))
 
     def delete(self, project, task):
         """ Delete task """
 
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
         # Call the endpoint to get the task
-        ApiTaskDetails().get(project, task).get_json()
+        user_task = ApiTaskDetails().get(project, task).get_json()
 
-        # Execute SQL query to delete task from DB
-        db.execute_update("DELETE FROM task WHERE id = ?;", (
-            task
-        ))
+        # Execute SQL query to delete task from DB, wherever the archiver left it
+        with user_auth.db.lock:
+            user_auth.db.execute_update("DELETE FROM task WHERE id = ?;", (
+                user_task["id"],
+            ))
+            user_auth.db.execute_update("DELETE FROM task_archive WHERE id = ?;", (
+                user_task["id"],
+            ))
+
+        hub.publish(user_auth["id"], "delete", "task", user_task)
 
         return make_response(jsonify({ "deleted": True }))
 api.add_resource(ApiTaskDetails, "/api/projects/<string:project>/tasks/<string:task>")
 
 
 
+class ApiEvents(Resource):
+    """ Change events endpoint """
+
+    def get(self):
+        """ Stream the project and task changes of the user as Server-Sent Events """
+
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
+        # Resume after the last event the client received, if it says so
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id is not None:
+            if not last_event_id.isdigit():
+                abort(HTTP_CODES["BadRequest"], message="Invalid Last-Event-ID")
+            last_event_id = int(last_event_id)
+
+        def stream():
+            # Subscribe once the stream starts, a client gone before then leaves nothing behind
+            subscription, replay = hub.subscribe(user_auth["id"], last_event_id)
+            try:
+                # Answer right away, so the client sees the stream open before any event
+                yield f"retry: {EVENTS_RETRY}\n\n"
+
+                for message in replay:
+                    yield format_event(message)
+
+                # A subscription that fell behind is closed, the client reconnects and resumes from the buffer
+                while not subscription.overflowed:
+                    message = subscription.get(timeout=EVENTS_KEEPALIVE)
+                    yield format_event(message) if message else ": keep-alive\n\n"
+            finally:
+                hub.unsubscribe(user_auth["id"], subscription)
+
+        return Response(stream(), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache", "X-Accel-Buffering": "no"
+        })
+api.add_resource(ApiEvents, "/api/events")
+
+
+
+class ApiSync(Resource):
+    """ Delta sync endpoint """
+
+    def get(self):
+        """ Get the projects and tasks changed, or deleted, since a change version """
+
+        # Validates user auth before executing the endpoint
+        user_auth = ApiUserAuth().validate()
+
+        # Get the version the client is synced up to
+        since = request.args.get("since", "0")
+        if not since.isdigit():
+            abort(HTTP_CODES["BadRequest"], message="Invalid since version")
+        since = int(since)
+
+        # Get the current version, changes after it are left for the next sync
+        version = user_auth.db.execute_query("SELECT version FROM sync_version").fetchone()["version"]
+
+        # Get the changed projects and tasks from the DB, through the version indexes
+        user_projects = user_auth.db.execute_query("SELECT * FROM project WHERE user_id = ? AND version > ? AND version <= ?", (
+            user_auth["id"], since, version
+        )).fetchall()
+        user_tasks = user_auth.db.execute_query("SELECT task.* FROM project INNER JOIN task ON project.id = task.project_id WHERE project.user_id = ? AND task.version > ? AND task.version <= ?", (
+            user_auth["id"], since, version
+        )).fetchall()
+
+        # Archived tasks keep their version, so they are only sent until the client has them
+        user_tasks += user_auth.db.execute_query("SELECT task_archive.* FROM project INNER JOIN task_archive ON project.id = task_archive.project_id WHERE project.user_id = ? AND task_archive.version > ? AND task_archive.version <= ?", (
+            user_auth["id"], since, version
+        )).fetchall()
+
+        # Get the deleted projects and tasks
+        deleted = { "project": [], "task": [] }
+        for tombstone in user_auth.db.execute_query("SELECT table_name, row_id FROM tombstone WHERE user_id = ? AND version > ? AND version <= ?", (
+            user_auth["id"], since, version
+        )):
+            deleted[tombstone["table_name"]].append(tombstone["row_id"])
+
+        return make_response(jsonify({
+            "version": version, "projects": user_projects, "tasks": user_tasks, "deleted": deleted
+        }))
+api.add_resource(ApiSync, "/api/sync")
+
+
+
+class ApiMetrics(Resource):
+    """ Metrics endpoint """
+
+    def get(self):
+        """ Get the admission control metrics """
+
+        # Validates the operator auth before executing the endpoint
+        ApiAdminAuth().validate()
+
+        return make_response(jsonify(admission.metrics()))
+api.add_resource(ApiMetrics, "/api/metrics")
+
+
+
+class ApiAdminRebalance(Resource):
+    """ Shard rebalancing endpoint """
+
+    def post(self):
+        """ Move users between shards until their projects and tasks are spread evenly """
+
+        # Validates the operator auth before executing the endpoint
+        ApiAdminAuth().validate()
+
+        try:
+            moves = shards.rebalance()
+        except TimeoutError as error:
+            shed(HTTP_CODES["ServiceUnavailable"], str(error), 1)
+
+        return make_response(jsonify({
+            "moves": [{ "user_id": user_id, "source": source, "target": target } for user_id, source, target in moves]
+        }))
+api.add_resource(ApiAdminRebalance, "/api/admin/rebalance")
+
+
+
+class ApiAdminUserShard(Resource):
+    """ User shard endpoint """
+
+    put_body = ApiBodySchema(("shard", True, body_index))
+
+    def put(self, user):
+        """ Move a user to another shard """
+
+        # Validates the operator auth before executing the endpoint
+        ApiAdminAuth().validate()
+
+        # Parse the body and validates
+        request_body = self.put_body.parse()
+
+        # Verify the user and the shard exist
+        if not shards.directory.execute_query("SELECT user_id FROM user_shard WHERE user_id=?", (user,)).fetchone():
+            abort(HTTP_CODES["NotFound"], message="Non existent user")
+        if not 0 <= request_body["shard"] < len(shards.shards):
+            abort(HTTP_CODES["BadRequest"], message={ "shard": "Non existent shard" })
+
+        try:
+            shards.move_user(user, request_body["shard"])
+        except TimeoutError as error:
+            shed(HTTP_CODES["ServiceUnavailable"], str(error), 1)
+
+        return make_response(jsonify({ "user_id": user, "shard": request_body["shard"] }))
+api.add_resource(ApiAdminUserShard, "/api/admin/users/<int:user>/shard")
+
+
+
+
+
+# ==========
+#  Commands
+# ==========
+
+# The shards live inside the server process, so the commands ask the running server to
+# rebalance through the admin endpoints, authenticated with the ADMIN_TOKEN of its environment
+
+def admin_request(url: str, method: str, path: str, body: dict | None = None) -> dict:
+    """ Sends a request to an admin endpoint of the running server """
+    req = urllib.request.Request(f"{url.rstrip('/')}{path}", method=method, data=json.dumps(body or {}).encode(), headers={
+        "Content-Type": "application/json", "X-Admin-Token": ADMIN_TOKEN or ""
+    })
+    try:
+        with urllib.request.urlopen(req) as res:
+            return json.load(res)
+    except urllib.error.HTTPError as error:
+        # Error pages are not always JSON, the server may answer with html
+        try:
+            message = json.load(error).get("message")
+        except ValueError:
+            message = error.reason
+        raise click.ClickException(f"{error.code}: {message}")
+    except urllib.error.URLError as error:
+        raise click.ClickException(f"Server not reachable: {error.reason}")
+
+@app.cli.command("rebalance")
+@click.option("--url", default="http://localhost:8000", help="Url of the running server")
+def rebalance_command(url):
+    """ Moves users between shards until their projects and tasks are spread evenly """
+    moves = admin_request(url, "POST", "/api/admin/rebalance")["moves"]
+    for move in moves:
+        click.echo(f"Moved user {move['user_id']} from shard {move['source']} to shard {move['target']}")
+    if not moves:
+        click.echo("Shards already balanced")
+
+@app.cli.command("move-user")
+@click.argument("user_id", type=int)
+@click.argument("shard", type=click.IntRange(min=0, max=len(SHARD_FILES) - 1))
+@click.option("--url", default="http://localhost:8000", help="Url of the running server")
+def move_user_command(user_id, shard, url):
+    """ Moves a user to another shard """
+    admin_request(url, "PUT", f"/api/admin/users/{user_id}/shard", { "shard": shard })
+    click.echo(f"Moved user {user_id} to shard {shard}")
+
+
+
 if __name__ == "__main__":
     if IS_DEVELOPMENT:
         app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,68 @@
+"""
+ Implements the archival of old completed tasks, keeping the task tables small.
+
+"""
+
+import threading
+
+
+class Archiver:
+    """Background job moving old completed tasks of every shard to their archive."""
+
+    def __init__(self, router, after_days, batch_size, interval, pause=0.05):
+        self.router = router
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def archive_batch(self, shard):
+        """Moves one batch of old completed tasks of the shard, returns how many."""
+        # Hold the router so users are not moved between shards mid batch, and the
+        # shard so no request reads or commits on its connection mid transaction
+        with self.router.lock, shard.lock:
+            ids = [row["id"] for row in shard.execute_query(
+                "SELECT id FROM task WHERE completed = 1 AND completed_at < datetime('now', ?) LIMIT ?",
+                (f"-{self.after_days} days", self.batch_size)
+            )]
+            if not ids:
+                return 0
+
+            placeholders = ", ".join("?" * len(ids))
+            with shard.conn:
+                shard.conn.execute(
+                    f"INSERT INTO task_archive SELECT *, datetime('now') FROM task WHERE id IN ({placeholders})", ids
+                )
+                shard.conn.execute(f"DELETE FROM task WHERE id IN ({placeholders})", ids)
+            return len(ids)
+
+    def run_once(self):
+        """Archives every old completed task, batch by batch, returns how many."""
+        archived = 0
+        for shard in self.router.shards:
+            while not self.stopped.is_set():
+                count = self.archive_batch(shard)
+                archived += count
+                if count < self.batch_size:
+                    break
+
+                # Let the requests through between batches
+                self.stopped.wait(self.pause)
+        return archived
+
+    def run(self):
+        """Archives the tasks every interval, until stopped."""
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        """Starts the job on a daemon thread."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="archiver", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the job."""
+        self.stopped.set()
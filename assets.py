@@ -0,0 +1,75 @@
+"""
+ Implements the static assets of the web client, kept in memory with hashed names.
+
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+
+class Asset:
+    """A static file with its gzip variant."""
+
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:16]
+
+        # Only keep the gzip variant when it is worth it
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        self.gzip = compressed if len(compressed) < len(data) else None
+
+
+class StaticAssets:
+    """Static files of a folder, served by content hashed names."""
+
+    def __init__(self, folder, url_path="/static", index="index.html"):
+        self.folder = folder
+        self.url_path = url_path
+        self.index = index
+        self.assets = {}
+        self.hashed_names = {}
+        self.immutable = set()
+        self.build()
+
+    def build(self):
+        """Loads every file, names it by its content and rewrites the index references."""
+        for root, _, files in os.walk(self.folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.folder).replace(os.sep, "/")
+                if name == self.index or filename.startswith("."):
+                    continue
+
+                with open(path, "rb") as fin:
+                    data = fin.read()
+                mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+                # Fingerprinted names never change content, the plain ones still can
+                stem, extension = os.path.splitext(name)
+                hashed_name = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+                self.hashed_names[name] = hashed_name
+                self.immutable.add(hashed_name)
+                self.assets[name] = self.assets[hashed_name] = Asset(data, mimetype)
+
+        with open(os.path.join(self.folder, self.index), encoding="utf-8") as fin:
+            html = fin.read()
+        self.assets[self.index] = Asset(self.rewrite(html).encode("utf-8"), "text/html")
+
+    def rewrite(self, html):
+        """Points the asset references of the html to their hashed names."""
+        def replace(match):
+            name = self.hashed_names.get(match.group(2), match.group(2))
+            return f"{match.group(1)}{self.url_path}/{name}{match.group(1)}"
+        return re.sub(rf"([\"']){re.escape(self.url_path)}/([^\"']+)\1", replace, html)
+
+    def get(self, name):
+        """Returns the asset with the name, or None."""
+        return self.assets.get(name)
+
+    def is_immutable(self, name):
+        """Returns if the name is a hashed one, whose content never changes."""
+        return name in self.immutable
@@ -0,0 +1,136 @@
+"""
+ Implements an in-process publish/subscribe hub for change events.
+
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+
+class Subscription:
+    """A single subscriber connection of a user."""
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def push(self, event):
+        """Queues an event, flagging the subscription if it cannot keep up."""
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Returns the next event, or None if none arrived within the timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """Fans out change events to the subscriptions of each user."""
+
+    def __init__(self, history=256, queue_size=64, idle_timeout=3600, sweep_interval=60):
+        self.history = history
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.published = 0
+        self.last_ids = {}
+        self.buffers = {}
+        self.subscribers = {}
+        self.touched = {}
+        self.swept = time.monotonic()
+
+    def publish(self, user_id, event, table, row):
+        """Publishes an event to every subscription of the user."""
+        user_id = str(user_id)
+        with self.lock:
+            # Ids of a user evicted and seen again continue after every id given so far,
+            # so clients resuming from an id of before are told to reset
+            self.published += 1
+            self.last_ids[user_id] = self.last_ids.get(user_id, self.published - 1) + 1
+            self.touched[user_id] = time.monotonic()
+            message = {
+                "id": self.last_ids[user_id],
+                "event": event,
+                "data": json.dumps({"table": table, "row": row}),
+            }
+            self.buffers.setdefault(user_id, deque(maxlen=self.history)).append(message)
+
+            for subscription in self.subscribers.get(user_id, ()):
+                subscription.push(message)
+
+            self.sweep()
+        return message["id"]
+
+    def subscribe(self, user_id, last_event_id=None):
+        """Registers a new subscription, returns it with the events to replay.
+
+        When the requested events already left the buffer the replay is a
+        single reset event, telling the client to do a full reload.
+        """
+        user_id = str(user_id)
+        subscription = Subscription(self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+            buffer = self.buffers.get(user_id, ())
+            last_id = self.last_ids.get(user_id, 0)
+
+            replay = []
+            if last_event_id is not None:
+                replay = [message for message in buffer if message["id"] > last_event_id]
+                # The events after the last seen one were evicted, or never existed here
+                if last_event_id > last_id or (buffer and buffer[0]["id"] > last_event_id + 1):
+                    replay = [{"id": last_id, "event": "reset", "data": "{}"}]
+
+        return subscription, replay
+
+    def unsubscribe(self, user_id, subscription):
+        """Removes a subscription from the user."""
+        user_id = str(user_id)
+        with self.lock:
+            subscribers = self.subscribers.get(user_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.subscribers.pop(user_id, None)
+
+            # Keep the buffer around for a reconnecting client
+            if user_id in self.buffers:
+                self.touched[user_id] = time.monotonic()
+            self.sweep()
+
+    def sweep(self, force=False):
+        """Drops the buffers of users with no subscription, idle for a while.
+
+        Must be called holding the lock.
+        """
+        now = time.monotonic()
+        if not force and now - self.swept < self.sweep_interval:
+            return
+        self.swept = now
+        for user_id, touched in list(self.touched.items()):
+            if user_id not in self.subscribers and now - touched >= self.idle_timeout:
+                del self.touched[user_id]
+                self.last_ids.pop(user_id, None)
+                self.buffers.pop(user_id, None)
+
+    def reset(self):
+        """Drops every buffered event and subscription."""
+        with self.lock:
+            self.published = 0
+            self.last_ids.clear()
+            self.buffers.clear()
+            self.subscribers.clear()
+            self.touched.clear()
+
+
+def format_event(message):
+    """Formats a message as a Server-Sent Event."""
+    return f'id: {message["id"]}\nevent: {message["event"]}\ndata: {message["data"]}\n\n'
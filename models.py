@@ -1,9 +1,22 @@
 """
- Implements a simple database of users.
+ Implements a simple database of users, with their projects and tasks split across shards.
 
 """
 
 import sqlite3
+import threading
+
+
+class QueryResult(list):
+    """Rows of a query, fetched while the connection was held."""
+
+    def fetchone(self):
+        """Returns the first row, or None."""
+        return self[0] if self else None
+
+    def fetchall(self):
+        """Returns every row."""
+        return list(self)
 
 
 class Database:
@@ -14,6 +27,9 @@ class Database:
         self.schema = schema
         self.conn = sqlite3.connect(filename, check_same_thread=False)
 
+        # The connection is shared by every thread, statements and transactions take turns on it
+        self.lock = threading.RLock()
+
         def dict_factory(cursor, row):
             """Converts table row to dictionary."""
             res = {}
@@ -25,19 +41,248 @@ class Database:
 
     def recreate(self):
         """Recreates the database from the schema file."""
-        with open(self.schema) as fin:
+        self.load(self.schema)
+
+    def load(self, filename):
+        """Executes a SQL script file."""
+        with open(filename) as fin, self.lock:
             self.conn.cursor().executescript(fin.read())
 
     def execute_query(self, stmt, args=()):
-        """Executes a query."""
-        res = self.conn.cursor().execute(stmt, args)
-        return res
+        """Executes a query and returns its rows."""
+        with self.lock:
+            return QueryResult(self.conn.cursor().execute(stmt, args))
 
     def execute_update(self, stmt, args=()):
         """Executes an insert or update and returns the last row id."""
-        cursor = self.conn.cursor()
-        cursor.execute(stmt, args)
-        self.conn.commit()
-        uid = cursor.lastrowid
-        cursor.close()
-        return uid
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(stmt, args)
+            self.conn.commit()
+            uid = cursor.lastrowid
+            cursor.close()
+            return uid
+
+
+class Shard(Database):
+    """Database holding the projects and tasks of some users."""
+
+    def __init__(self, filename, schema, index, count):
+        super().__init__(filename, schema)
+        self.index = index
+        self.count = count
+
+    def start_ids(self, after=0):
+        """Starts the ids of this shard after the given id."""
+        last_id = after - (after - self.index) % self.count
+        for name in ("project", "task"):
+            self.execute_update("INSERT OR REPLACE INTO id_sequence VALUES (?, ?)", (name, last_id))
+
+    def unarchive_task(self, task_id):
+        """Moves a task back from the archive to the task table, if it was archived."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT INTO task ({ShardRouter.TASK_COLUMNS}) SELECT {ShardRouter.TASK_COLUMNS} FROM task_archive WHERE id = ?",
+                (task_id,)
+            )
+            self.conn.execute("DELETE FROM task_archive WHERE id = ?", (task_id,))
+
+    def next_id(self, name):
+        """Returns a new id for a row of the table, unique across every shard."""
+        with self.lock:
+            self.execute_update("UPDATE id_sequence SET last_id = last_id + ? WHERE name = ?", (self.count, name))
+            return self.execute_query("SELECT last_id FROM id_sequence WHERE name = ?", (name,)).fetchone()["last_id"]
+
+
+class ShardRouter:
+    """Routes each user to the shard holding their projects and tasks."""
+
+    PROJECT_COLUMNS = "id, user_id, title, creation_date, last_updated"
+    TASK_COLUMNS = "id, project_id, title, creation_date, completed, completed_at"
+
+    def __init__(self, directory, shard_files, shard_schema, seed=None, move_timeout=30):
+        self.directory = directory
+        self.shard_schema = shard_schema
+        self.seed = seed
+        self.shards = [
+            Shard(filename, shard_schema, index, len(shard_files))
+            for index, filename in enumerate(shard_files)
+        ]
+        self.lock = threading.RLock()
+
+        # Requests using the shard of each user, and the users being moved
+        self.move_timeout = move_timeout
+        self.leases = {}
+        self.moving = set()
+        self.placement = threading.Condition()
+
+    def recreate(self):
+        """Recreates the directory and every shard, loading the seed data."""
+        with self.lock:
+            self.directory.recreate()
+            for shard in self.shards:
+                shard.recreate()
+
+            users = self.directory.execute_query("SELECT id FROM user").fetchall()
+            for user in users:
+                self.assign(user["id"])
+
+            # Spread the seed data through the shards of its users
+            last_id = 0
+            if self.seed:
+                staging = Database(":memory:", self.shard_schema)
+                staging.recreate()
+                staging.load(self.seed)
+                for user in users:
+                    self.copy_user(staging, self.for_user(user["id"]), user["id"])
+                last_id = staging.execute_query(
+                    "SELECT MAX(id) AS id FROM (SELECT id FROM project UNION ALL SELECT id FROM task)"
+                ).fetchone()["id"] or 0
+
+            for shard in self.shards:
+                shard.start_ids(last_id)
+
+    def assign(self, user_id):
+        """Assigns a new user to a shard, returns it."""
+        shard = int(user_id) % len(self.shards)
+        self.directory.execute_update("INSERT OR IGNORE INTO user_shard VALUES (?, ?)", (user_id, shard))
+        return self.for_user(user_id)
+
+    def for_user(self, user_id):
+        """Returns the shard of the user."""
+        row = self.directory.execute_query("SELECT shard FROM user_shard WHERE user_id = ?", (user_id,)).fetchone()
+        return self.shards[row["shard"]]
+
+    def acquire(self, user_id):
+        """Returns the shard of the user, keeping them on it until released.
+
+        Returns None while the user is being moved.
+        """
+        user_id = int(user_id)
+        with self.placement:
+            if user_id in self.moving:
+                return None
+            self.leases[user_id] = self.leases.get(user_id, 0) + 1
+        return self.for_user(user_id)
+
+    def release(self, user_id):
+        """Lets the user be moved again, once every request released them."""
+        user_id = int(user_id)
+        with self.placement:
+            self.leases[user_id] -= 1
+            if not self.leases[user_id]:
+                del self.leases[user_id]
+                self.placement.notify_all()
+
+    @staticmethod
+    def copy_user(source, target, user_id):
+        """Copies the projects, tasks, archived tasks and tombstones of the user between databases."""
+        projects = source.execute_query(
+            f"SELECT {ShardRouter.PROJECT_COLUMNS} FROM project WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        tasks = source.execute_query(
+            f"SELECT {', '.join('task.' + column for column in ShardRouter.TASK_COLUMNS.split(', '))} "
+            "FROM project INNER JOIN task ON project.id = task.project_id WHERE project.user_id = ?", (user_id,)
+        ).fetchall()
+        archived_tasks = source.execute_query(
+            "SELECT task_archive.* FROM project INNER JOIN task_archive ON project.id = task_archive.project_id "
+            "WHERE project.user_id = ?", (user_id,)
+        ).fetchall()
+        tombstones = source.execute_query("SELECT * FROM tombstone WHERE user_id = ?", (user_id,)).fetchall()
+
+        with target.lock, target.conn:
+            target.conn.executemany(
+                f"INSERT INTO project ({ShardRouter.PROJECT_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+                [tuple(project.values()) for project in projects]
+            )
+            target.conn.executemany(
+                f"INSERT INTO task ({ShardRouter.TASK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                [tuple(task.values()) for task in tasks]
+            )
+            target.conn.executemany(
+                "INSERT INTO task_archive VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [tuple(task.values()) for task in archived_tasks]
+            )
+            target.conn.executemany(
+                "INSERT INTO tombstone VALUES (?, ?, ?, ?)",
+                [tuple(tombstone.values()) for tombstone in tombstones]
+            )
+
+    def move_user(self, user_id, index):
+        """Moves the projects and tasks of the user to another shard.
+
+        New requests of the user are refused while it runs, and it waits for
+        the ones in flight to finish, so no write lands on the old shard.
+        """
+        user_id = int(user_id)
+        if not 0 <= index < len(self.shards):
+            raise ValueError(f"Non existent shard {index}")
+
+        with self.lock:
+            source = self.for_user(user_id)
+            target = self.shards[index]
+            if source is target:
+                return
+
+            with self.placement:
+                self.moving.add(user_id)
+                if not self.placement.wait_for(lambda: user_id not in self.leases, self.move_timeout):
+                    self.moving.discard(user_id)
+                    raise TimeoutError(f"User {user_id} still has requests in flight")
+            try:
+                # Keep the change versions of the user moving forward on the new shard
+                version = source.execute_query("SELECT version FROM sync_version").fetchone()["version"]
+                target.execute_update("UPDATE sync_version SET version = MAX(version, ?)", (version,))
+
+                self.copy_user(source, target, user_id)
+                self.directory.execute_update("UPDATE user_shard SET shard = ? WHERE user_id = ?", (index, user_id))
+
+                with source.lock, source.conn:
+                    source.conn.execute(
+                        "DELETE FROM task WHERE project_id IN (SELECT id FROM project WHERE user_id = ?)", (user_id,)
+                    )
+                    source.conn.execute(
+                        "DELETE FROM task_archive WHERE project_id IN (SELECT id FROM project WHERE user_id = ?)", (user_id,)
+                    )
+                    source.conn.execute("DELETE FROM project WHERE user_id = ?", (user_id,))
+                    source.conn.execute("DELETE FROM tombstone WHERE user_id = ?", (user_id,))
+            finally:
+                with self.placement:
+                    self.moving.discard(user_id)
+
+    def loads(self):
+        """Returns the number of projects and tasks of each user, by shard."""
+        loads = [{} for _ in self.shards]
+        for row in self.directory.execute_query("SELECT user_id, shard FROM user_shard"):
+            loads[row["shard"]][row["user_id"]] = 0
+        for shard, users in zip(self.shards, loads):
+            for row in shard.execute_query(
+                "SELECT project.user_id, COUNT(DISTINCT project.id) + COUNT(task.id) AS rows "
+                "FROM project LEFT JOIN task ON project.id = task.project_id GROUP BY project.user_id"
+            ):
+                if row["user_id"] in users:
+                    users[row["user_id"]] = row["rows"]
+        return loads
+
+    def rebalance(self):
+        """Moves users from the fullest shards to the emptiest, returns the moves made."""
+        with self.lock:
+            loads = self.loads()
+            moves = []
+            while True:
+                totals = [sum(users.values()) for users in loads]
+                fullest = totals.index(max(totals))
+                emptiest = totals.index(min(totals))
+
+                # Move the largest user that still leaves the fullest shard above the emptiest
+                movable = [
+                    (rows, user_id) for user_id, rows in loads[fullest].items()
+                    if 0 < rows < totals[fullest] - totals[emptiest]
+                ]
+                if not movable:
+                    return moves
+                rows, user_id = max(movable)
+
+                self.move_user(user_id, emptiest)
+                loads[emptiest][user_id] = loads[fullest].pop(user_id)
+                moves.append((user_id, fullest, emptiest))
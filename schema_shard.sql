@@ -0,0 +1,123 @@
+-- IDS
+-- Last id given by this shard, each shard gives ids in its own residue class
+-- modulo the shard count, so they stay unique when users move between shards
+DROP TABLE IF EXISTS id_sequence;
+CREATE TABLE id_sequence (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER
+);
+
+
+-- SYNC
+-- Monotonic change version, bumped on every project and task change
+DROP TABLE IF EXISTS sync_version;
+CREATE TABLE sync_version (
+    version INTEGER
+);
+
+INSERT INTO sync_version VALUES (0);
+
+-- Deleted rows, kept so clients can sync the deletes
+DROP TABLE IF EXISTS tombstone;
+CREATE TABLE tombstone (
+    table_name TEXT,
+    row_id INTEGER,
+    user_id INTEGER,
+    version INTEGER
+);
+
+CREATE INDEX tombstone_user_version ON tombstone(user_id, version);
+
+
+-- PROJECTS
+DROP TABLE IF EXISTS project;
+CREATE TABLE project (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    title TEXT,
+    creation_date TEXT,
+    last_updated TEXT,
+    version INTEGER
+);
+
+CREATE INDEX project_user_version ON project(user_id, version);
+
+CREATE TRIGGER project_insert_version AFTER INSERT ON project BEGIN
+    UPDATE sync_version SET version = version + 1;
+    UPDATE project SET version = (SELECT version FROM sync_version) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER project_update_version AFTER UPDATE OF user_id, title, creation_date, last_updated ON project BEGIN
+    UPDATE sync_version SET version = version + 1;
+    UPDATE project SET version = (SELECT version FROM sync_version) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER project_delete_version AFTER DELETE ON project BEGIN
+    UPDATE sync_version SET version = version + 1;
+    INSERT INTO tombstone VALUES ('project', OLD.id, OLD.user_id, (SELECT version FROM sync_version));
+END;
+
+
+-- TASKS
+DROP TABLE IF EXISTS task;
+CREATE TABLE task (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER,
+    title TEXT,
+    creation_date TEXT,
+    completed INTEGER,
+    completed_at TEXT,
+    version INTEGER,
+    FOREIGN KEY(project_id) REFERENCES project(id)
+);
+
+CREATE INDEX task_project_version ON task(project_id, version);
+CREATE INDEX task_completed_at ON task(completed_at) WHERE completed = 1;
+
+CREATE TRIGGER task_insert_completed AFTER INSERT ON task WHEN NEW.completed = 1 AND NEW.completed_at IS NULL BEGIN
+    UPDATE task SET completed_at = datetime('now') WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER task_update_completed AFTER UPDATE OF completed ON task WHEN NEW.completed IS NOT OLD.completed BEGIN
+    UPDATE task SET completed_at = CASE WHEN NEW.completed = 1 THEN datetime('now') END WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER task_insert_version AFTER INSERT ON task BEGIN
+    UPDATE sync_version SET version = version + 1;
+    UPDATE task SET version = (SELECT version FROM sync_version) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER task_update_version AFTER UPDATE OF project_id, title, creation_date, completed ON task BEGIN
+    UPDATE sync_version SET version = version + 1;
+    UPDATE task SET version = (SELECT version FROM sync_version) WHERE id = NEW.id;
+END;
+
+-- Tasks moved to the archive are not deleted for the clients
+CREATE TRIGGER task_delete_version AFTER DELETE ON task WHEN NOT EXISTS (SELECT 1 FROM task_archive WHERE id = OLD.id) BEGIN
+    UPDATE sync_version SET version = version + 1;
+    INSERT INTO tombstone VALUES ('task', OLD.id, (SELECT user_id FROM project WHERE id = OLD.project_id), (SELECT version FROM sync_version));
+END;
+
+
+-- ARCHIVED TASKS
+-- Completed tasks moved out of the task table once old enough
+DROP TABLE IF EXISTS task_archive;
+CREATE TABLE task_archive (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER,
+    title TEXT,
+    creation_date TEXT,
+    completed INTEGER,
+    completed_at TEXT,
+    version INTEGER,
+    archived_at TEXT,
+    FOREIGN KEY(project_id) REFERENCES project(id)
+);
+
+CREATE INDEX task_archive_project_version ON task_archive(project_id, version);
+
+-- Tasks moved back to the task table are not deleted for the clients
+CREATE TRIGGER task_archive_delete_version AFTER DELETE ON task_archive WHEN NOT EXISTS (SELECT 1 FROM task WHERE id = OLD.id) BEGIN
+    UPDATE sync_version SET version = version + 1;
+    INSERT INTO tombstone VALUES ('task', OLD.id, (SELECT user_id FROM project WHERE id = OLD.project_id), (SELECT version FROM sync_version));
+END;
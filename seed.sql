@@ -0,0 +1,15 @@
+-- PROJECTS
+INSERT INTO project (user_id, title, creation_date, last_updated) VALUES (1, 'Doughnuts', '2020-05-01', '2020-06-01');
+INSERT INTO project (user_id, title, creation_date, last_updated) VALUES (1, 'Eat well', '2020-05-01', '2020-05-02');
+INSERT INTO project (user_id, title, creation_date, last_updated) VALUES (2, 'Save the world!', '2020-05-07', '2020-06-01');
+
+
+-- TASKS
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (1, 'Search for doughnuts', '2020-05-05', 1);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (1, 'Eat cream', '2020-05-05', 0);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (2, 'Eat vegetables everyday', '2020-05-10', 1);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (2, 'Eat doughnuts everyday', '2020-05-11', 1);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (2, 'Eat lots of sugar', '2020-05-12', 0);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (3, 'See who needs to be saved', '2020-05-07', 0);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (3, 'Save those who needs to be saved', '2020-05-07', 0);
+INSERT INTO task (project_id, title, creation_date, completed) VALUES (3, 'Save those from being not saved', '2020-05-08', 1);
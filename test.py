@@ -4,10 +4,13 @@
 """
 
 import base64
+import gzip
 import unittest
 from json import dumps
 
-from app import app, db
+import app as application
+from app import app, shards, hub, admission, assets, archiver, RATE_LIMITS
+from admission import ConcurrencyLimiter
 
 
 def auth_header(username, password):
@@ -23,8 +26,9 @@ class TestBase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         self.client = app.test_client()
-        self.db = db
+        self.db = shards
         self.db.recreate()
+        admission.reset()
 
     def tearDown(self):
         pass
@@ -308,6 +312,47 @@ class TestTasks(TestBase):
         res = self.client.put('/api/projects/1/tasks/1', headers=credentials, data=dumps(body), content_type='application/json')
         self.assertEqual(res.get_json()["title"], body["title"])
 
+    def test_create_completed_flag(self):
+        """ Tests the completed property is stored as a flag """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "title": "test_project", "completed": True }
+
+        res = self.client.post('/api/projects/1/tasks', headers=credentials, data=dumps(body), content_type='application/json')
+        self.assertEqual(res.get_json()["completed"], 1)
+
+    def test_create_invalid_completed(self):
+        """ Tests creating a task with a completed property that is not a boolean """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "title": "test_project", "completed": "maybe" }
+
+        res = self.client.post('/api/projects/1/tasks', headers=credentials, data=dumps(body), content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_edit_uncomplete(self):
+        """ Tests a completed task can be set back to not completed """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "completed": "false" }
+
+        self.client.put('/api/projects/1/tasks/1', headers=credentials, data=dumps(body), content_type='application/json')
+        res = self.client.get('/api/projects/1/tasks/1', headers=credentials)
+        self.assertEqual(res.get_json()["completed"], 0)
+
+    def test_edit_returns_completed_at(self):
+        """ Tests completing a task returns when it was completed """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "completed": True }
+
+        res = self.client.put('/api/projects/1/tasks/2', headers=credentials, data=dumps(body), content_type='application/json')
+        self.assertIsNotNone(res.get_json()["completed_at"])
+
     def test_delete(self):
         """ Tests deleting a task """
 
@@ -330,4 +375,585 @@ class TestTasks(TestBase):
         credentials = auth_header('homer', '1234')
 
         res = self.client.delete('/api/projects/6/tasks/1', headers=credentials)
-        self.assertEqual(res.status_code, 404)
\ No newline at end of file
+        self.assertEqual(res.status_code, 404)
+
+
+
+class TestEvents(TestBase):
+    """Tests for the change events endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        hub.reset()
+
+    def read_event(self, headers, skip=1):
+        """ Opens the event stream and returns its first event, after the retry line """
+
+        res = self.client.get('/api/events', headers=headers, buffered=False)
+        try:
+            chunks = iter(res.response)
+            for _ in range(skip):
+                next(chunks)
+            return next(chunks).decode()
+        finally:
+            res.close()
+
+    def test_stream_opens_right_away(self):
+        """ Tests the stream answers at once, even with no event to send """
+
+        event = self.read_event(auth_header('homer', '1234'), skip=0)
+        self.assertTrue(event.startswith("retry: "))
+        self.assertEqual(hub.subscribers, {})
+
+    def test_access_endpoint_no_auth(self):
+        """ Tests trying to access the events endpoint without being authorized """
+
+        res = self.client.get('/api/events')
+        self.assertEqual(res.status_code, 403)
+
+    def test_invalid_last_event_id(self):
+        """ Tests resuming the events from an invalid id """
+
+        credentials = auth_header('homer', '1234')
+
+        res = self.client.get('/api/events', headers={ **credentials, "Last-Event-ID": "abc" })
+        self.assertEqual(res.status_code, 400)
+
+    def test_resume_events(self):
+        """ Tests a reconnecting client receives the events it missed """
+
+        credentials = auth_header('homer', '1234')
+
+        self.client.post('/api/projects', headers=credentials, data=dumps({ "title": "first" }), content_type='application/json')
+        self.client.put('/api/projects/1', headers=credentials, data=dumps({ "title": "second" }), content_type='application/json')
+
+        event = self.read_event({ **credentials, "Last-Event-ID": "1" })
+        self.assertTrue(event.startswith("id: 2\nevent: update\n"))
+        self.assertIn('"title": "second"', event)
+
+    def test_events_only_from_user(self):
+        """ Tests the events of a user are not sent to other users """
+
+        self.client.delete('/api/projects/3', headers=auth_header('bart', '1234'))
+
+        self.assertEqual(hub.subscribe(1, 0)[1], [])
+        self.assertEqual(len(hub.subscribe(2, 0)[1]), 1)
+
+    def test_resume_evicted_events(self):
+        """ Tests resuming from events no longer buffered asks for a full reload """
+
+        for _ in range(hub.history + 1):
+            hub.publish(1, "update", "project", {})
+
+        subscription, replay = hub.subscribe(1, 0)
+        self.assertEqual(replay[0]["event"], "reset")
+        self.assertEqual(replay[0]["id"], hub.history + 1)
+
+    def test_idle_buffers_dropped(self):
+        """ Tests the events of users idle with no subscription are dropped """
+
+        hub.publish(1, "update", "project", {})
+        subscription, _ = hub.subscribe(2)
+        hub.unsubscribe(2, subscription)
+        hub.touched["1"] -= hub.idle_timeout
+
+        with hub.lock:
+            hub.sweep(force=True)
+        self.assertEqual(hub.buffers, {})
+        self.assertEqual(hub.subscribers, {})
+
+    def test_resume_dropped_events(self):
+        """ Tests resuming from events of a dropped buffer asks for a full reload """
+
+        hub.publish(1, "update", "project", {})
+        hub.touched["1"] -= hub.idle_timeout
+        with hub.lock:
+            hub.sweep(force=True)
+        hub.publish(1, "update", "project", {})
+
+        subscription, replay = hub.subscribe(1, 0)
+        self.assertEqual(replay[0]["event"], "reset")
+
+    def test_slow_subscriber(self):
+        """ Tests a subscriber that does not keep up is flagged to be closed """
+
+        subscription, _ = hub.subscribe(1)
+        for _ in range(hub.queue_size + 1):
+            hub.publish(1, "update", "project", {})
+
+        self.assertTrue(subscription.overflowed)
+
+
+
+class TestSync(TestBase):
+    """Tests for the delta sync endpoint."""
+
+    def setUp(self):
+        super().setUp()
+
+    def test_access_endpoint_no_auth(self):
+        """ Tests trying to access the sync endpoint without being authorized """
+
+        res = self.client.get('/api/sync')
+        self.assertEqual(res.status_code, 403)
+
+    def test_invalid_since(self):
+        """ Tests syncing from an invalid version """
+
+        credentials = auth_header('homer', '1234')
+
+        res = self.client.get('/api/sync?since=abc', headers=credentials)
+        self.assertEqual(res.status_code, 400)
+
+    def test_full_sync(self):
+        """ Tests syncing from the start returns all the user data """
+
+        credentials = auth_header('homer', '1234')
+
+        res = self.client.get('/api/sync', headers=credentials)
+        self.assertEqual(len(res.get_json()["projects"]), 2)
+        self.assertEqual(len(res.get_json()["tasks"]), 5)
+
+    def test_delta_sync(self):
+        """ Tests syncing returns only the changes since the version """
+
+        credentials = auth_header('homer', '1234')
+
+        version = self.client.get('/api/sync', headers=credentials).get_json()["version"]
+
+        body = { "title": "test_new_title" }
+        self.client.put('/api/projects/1/tasks/2', headers=credentials, data=dumps(body), content_type='application/json')
+        self.client.delete('/api/projects/2', headers=credentials)
+
+        res = self.client.get(f'/api/sync?since={version}', headers=credentials).get_json()
+        self.assertEqual(res["projects"], [])
+        self.assertEqual([task["id"] for task in res["tasks"]], [2])
+        self.assertEqual(res["deleted"], { "project": [2], "task": [] })
+        self.assertEqual(res["version"], version + 2)
+
+    def test_edit_returns_version(self):
+        """ Tests editing a project returns its new change version """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "title": "test_new_title" }
+
+        res = self.client.put('/api/projects/1', headers=credentials, data=dumps(body), content_type='application/json')
+        sync = self.client.get('/api/sync', headers=credentials).get_json()
+        self.assertEqual(res.get_json()["version"], sync["version"])
+
+
+
+class TestAdmission(TestBase):
+    """Tests for the admission control."""
+
+    def setUp(self):
+        super().setUp()
+        self.concurrency = admission.concurrency
+        application.ADMIN_TOKEN = "unittest"
+
+    def tearDown(self):
+        admission.concurrency = self.concurrency
+        application.ADMIN_TOKEN = None
+
+    def test_rate_limited(self):
+        """ Tests a user going over the write rate limit is rejected """
+
+        credentials = auth_header('homer', '1234')
+
+        body = { "title": "test_new_title" }
+
+        for _ in range(RATE_LIMITS["write"][1]):
+            self.client.put('/api/projects/1', headers=credentials, data=dumps(body), content_type='application/json')
+
+        res = self.client.put('/api/projects/1', headers=credentials, data=dumps(body), content_type='application/json')
+        self.assertEqual(res.status_code, 429)
+        self.assertIn("Retry-After", res.headers)
+
+    def test_rate_limit_per_user_and_kind(self):
+        """ Tests the write rate limit of a user does not limit reads or other users """
+
+        body = { "title": "test_new_title" }
+
+        for _ in range(RATE_LIMITS["write"][1] + 1):
+            self.client.put('/api/projects/1', headers=auth_header('homer', '1234'), data=dumps(body), content_type='application/json')
+
+        res = self.client.get('/api/projects', headers=auth_header('homer', '1234'))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.put('/api/projects/3', headers=auth_header('bart', '1234'), data=dumps(body), content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+
+    def test_overloaded(self):
+        """ Tests requests are shed when every slot is taken and the queue is full """
+
+        admission.concurrency = ConcurrencyLimiter(1, 0, 0)
+        admission.concurrency.acquire()
+
+        res = self.client.get('/api/projects', headers=auth_header('homer', '1234'))
+        self.assertEqual(res.status_code, 503)
+        self.assertIn("Retry-After", res.headers)
+
+    def test_metrics(self):
+        """ Tests the shed requests are counted in the metrics """
+
+        admission.concurrency = ConcurrencyLimiter(1, 0, 0)
+        admission.concurrency.acquire()
+
+        self.client.get('/api/projects', headers=auth_header('homer', '1234'))
+
+        res = self.client.get('/api/metrics', headers={ "X-Admin-Token": "unittest" })
+        self.assertEqual(res.get_json()["shed"], { "overloaded": 1 })
+
+    def test_metrics_no_auth(self):
+        """ Tests the metrics need the admin token """
+
+        res = self.client.get('/api/metrics', headers={ "X-Admin-Token": "wrong" })
+        self.assertEqual(res.status_code, 403)
+
+    def test_idle_buckets_dropped(self):
+        """ Tests the buckets of users that stopped sending requests are dropped """
+
+        self.client.get('/api/projects', headers=auth_header('homer', '1234'))
+        admission.buckets[("1", "read")].updated -= 60
+
+        admission.sweep()
+        self.assertEqual(admission.buckets, {})
+
+
+
+class TestShards(TestBase):
+    """Tests for the sharding of projects and tasks by user."""
+
+    def setUp(self):
+        super().setUp()
+
+    def test_users_on_own_shards(self):
+        """ Tests the seeded users are spread on different shards """
+
+        self.assertIsNot(shards.for_user(1), shards.for_user(2))
+
+    def test_register_assigns_shard(self):
+        """ Tests a registered user can create projects on their shard """
+
+        body = { "username": "unittest", "password": "unittest", "email": "unittest", "name": "unittest" }
+        self.client.post('/api/user/register', data=dumps(body), content_type='application/json')
+
+        credentials = auth_header('unittest', 'unittest')
+
+        self.client.post('/api/projects', headers=credentials, data=dumps({ "title": "test_project" }), content_type='application/json')
+        res = self.client.get('/api/projects', headers=credentials)
+        self.assertEqual(len(res.get_json()), 1)
+
+    def test_unique_ids_across_shards(self):
+        """ Tests projects created on different shards get different ids """
+
+        body = { "title": "test_project" }
+
+        homer = self.client.post('/api/projects', headers=auth_header('homer', '1234'), data=dumps(body), content_type='application/json')
+        bart = self.client.post('/api/projects', headers=auth_header('bart', '1234'), data=dumps(body), content_type='application/json')
+        self.assertNotEqual(homer.get_json()["id"], bart.get_json()["id"])
+
+    def test_move_user(self):
+        """ Tests a moved user keeps their projects and tasks, and syncs them again """
+
+        credentials = auth_header('homer', '1234')
+
+        version = self.client.get('/api/sync', headers=credentials).get_json()["version"]
+
+        shards.move_user(1, 2)
+
+        self.assertIs(shards.for_user(1), shards.shards[2])
+        self.assertEqual(len(self.client.get('/api/projects/1/tasks', headers=credentials).get_json()), 2)
+
+        res = self.client.get(f'/api/sync?since={version}', headers=credentials).get_json()
+        self.assertEqual(len(res["projects"]), 2)
+        self.assertEqual(len(res["tasks"]), 5)
+
+    def test_request_while_moving(self):
+        """ Tests the requests of a user being moved are refused """
+
+        shards.moving.add(1)
+        try:
+            res = self.client.get('/api/projects', headers=auth_header('homer', '1234'))
+        finally:
+            shards.moving.discard(1)
+        self.assertEqual(res.status_code, 503)
+
+    def test_move_waits_for_requests(self):
+        """ Tests a user is not moved while a request still uses their shard """
+
+        shards.acquire(1)
+        move_timeout = shards.move_timeout
+        shards.move_timeout = 0
+        try:
+            with self.assertRaises(TimeoutError):
+                shards.move_user(1, 2)
+        finally:
+            shards.release(1)
+            shards.move_timeout = move_timeout
+        self.assertIsNot(shards.for_user(1), shards.shards[2])
+
+    def test_rebalance(self):
+        """ Tests rebalancing moves users off a crowded shard """
+
+        shards.move_user(2, 1)
+
+        moves = shards.rebalance()
+        self.assertEqual(len(moves), 1)
+        self.assertIsNot(shards.for_user(1), shards.for_user(2))
+
+
+
+class TestAssets(TestBase):
+    """Tests for the web page and static files."""
+
+    def setUp(self):
+        super().setUp()
+
+    def test_index_hashed_references(self):
+        """ Tests the web page references the hashed static files """
+
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(f'/static/{assets.hashed_names["script.js"]}', res.get_data(as_text=True))
+
+    def test_index_not_modified(self):
+        """ Tests the web page is not sent again when the client has it """
+
+        etag = self.client.get('/').headers["ETag"]
+
+        res = self.client.get('/', headers={ "If-None-Match": etag })
+        self.assertEqual(res.status_code, 304)
+
+    def test_hashed_immutable(self):
+        """ Tests the hashed static files are cached for good """
+
+        res = self.client.get(f'/static/{assets.hashed_names["script.js"]}')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("immutable", res.headers["Cache-Control"])
+
+    def test_plain_revalidated(self):
+        """ Tests the static files by their plain name are revalidated """
+
+        res = self.client.get('/static/script.js')
+        self.assertEqual(res.headers["Cache-Control"], "no-cache")
+
+    def test_gzip(self):
+        """ Tests the static files are sent compressed when the client accepts it """
+
+        res = self.client.get(f'/static/{assets.hashed_names["script.js"]}', headers={ "Accept-Encoding": "gzip" })
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(res.get_data()), assets.get("script.js").data)
+
+    def test_gzip_refused(self):
+        """ Tests the static files are not compressed when the client refuses gzip """
+
+        res = self.client.get(f'/static/{assets.hashed_names["script.js"]}', headers={ "Accept-Encoding": "gzip;q=0, identity" })
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(res.get_data(), assets.get("script.js").data)
+
+    def test_nonexistent(self):
+        """ Tests getting a static file that doesnt exists """
+
+        res = self.client.get('/static/nonexistent.js')
+        self.assertEqual(res.status_code, 404)
+
+
+
+class TestArchive(TestBase):
+    """Tests for the archival of old completed tasks."""
+
+    def setUp(self):
+        super().setUp()
+
+    def age_completed_tasks(self):
+        """ Makes the completed tasks of homer old enough to be archived """
+        shards.for_user(1).execute_update("UPDATE task SET completed_at = '2020-01-01' WHERE completed = 1")
+
+    def test_recent_not_archived(self):
+        """ Tests recently completed tasks are kept """
+
+        self.assertEqual(archiver.run_once(), 0)
+
+    def test_archive_old_completed(self):
+        """ Tests old completed tasks are archived and left out of the tasks list """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        self.assertEqual(archiver.run_once(), 3)
+
+        res = self.client.get('/api/projects/1/tasks', headers=credentials)
+        self.assertEqual([task["id"] for task in res.get_json()], [2])
+
+    def test_include_archived(self):
+        """ Tests the tasks list includes the archived tasks when asked for """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        res = self.client.get('/api/projects/1/tasks?include_archived=true', headers=credentials)
+        self.assertEqual(len(res.get_json()), 2)
+
+    def test_archive_in_batches(self):
+        """ Tests the archival goes through every batch """
+
+        self.age_completed_tasks()
+
+        batch_size = archiver.batch_size
+        archiver.batch_size = 1
+        try:
+            self.assertEqual(archiver.run_once(), 3)
+        finally:
+            archiver.batch_size = batch_size
+
+    def test_get_archived(self):
+        """ Tests getting an archived task """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        res = self.client.get('/api/projects/1/tasks/1', headers=credentials)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("archived_at", res.get_json())
+
+    def test_edit_archived(self):
+        """ Tests editing an archived task moves it back to the tasks list """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        body = { "title": "test_new_title", "completed": "false" }
+
+        res = self.client.put('/api/projects/1/tasks/1', headers=credentials, data=dumps(body), content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["title"], "test_new_title")
+        self.assertNotIn("archived_at", res.get_json())
+
+        res = self.client.get('/api/projects/1/tasks', headers=credentials)
+        self.assertEqual(sorted(task["id"] for task in res.get_json()), [1, 2])
+
+    def test_edit_archived_meanwhile(self):
+        """ Tests editing a task archived after it was read still updates it """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+
+        # Archive the task right after the endpoint reads it
+        get = application.ApiTaskDetails.get
+        def get_and_archive(resource, project, task):
+            res = get(resource, project, task)
+            archiver.run_once()
+            return res
+        application.ApiTaskDetails.get = get_and_archive
+        try:
+            body = { "title": "test_new_title" }
+
+            res = self.client.put('/api/projects/1/tasks/1', headers=credentials, data=dumps(body), content_type='application/json')
+        finally:
+            application.ApiTaskDetails.get = get
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["title"], "test_new_title")
+
+    def test_delete_archived(self):
+        """ Tests deleting an archived task, synced as deleted """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        version = self.client.get('/api/sync', headers=credentials).get_json()["version"]
+
+        res = self.client.delete('/api/projects/1/tasks/1', headers=credentials)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.get('/api/projects/1/tasks/1', headers=credentials)
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client.get(f'/api/sync?since={version}', headers=credentials).get_json()
+        self.assertEqual(res["deleted"]["task"], [1])
+
+    def test_sync_archived(self):
+        """ Tests a full sync includes the archived tasks """
+
+        credentials = auth_header('homer', '1234')
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        res = self.client.get('/api/sync', headers=credentials).get_json()
+        self.assertIn(1, [task["id"] for task in res["tasks"]])
+
+    def test_archived_not_synced_as_deleted(self):
+        """ Tests archiving a task is not synced as deleting it """
+
+        credentials = auth_header('homer', '1234')
+
+        version = self.client.get('/api/sync', headers=credentials).get_json()["version"]
+
+        self.age_completed_tasks()
+        archiver.run_once()
+
+        res = self.client.get(f'/api/sync?since={version}', headers=credentials).get_json()
+        self.assertEqual(res["deleted"]["task"], [])
+
+
+
+class TestAdminShards(TestBase):
+    """Tests for the shard admin endpoints."""
+
+    def setUp(self):
+        super().setUp()
+        application.ADMIN_TOKEN = "unittest"
+
+    def tearDown(self):
+        application.ADMIN_TOKEN = None
+
+    def test_no_token(self):
+        """ Tests the admin endpoints need the admin token """
+
+        res = self.client.post('/api/admin/rebalance', headers={ "X-Admin-Token": "wrong" })
+        self.assertEqual(res.status_code, 403)
+
+    def test_rebalance(self):
+        """ Tests rebalancing the live shards """
+
+        shards.move_user(2, 1)
+
+        res = self.client.post('/api/admin/rebalance', headers={ "X-Admin-Token": "unittest" })
+        self.assertEqual(len(res.get_json()["moves"]), 1)
+
+    def test_move_user(self):
+        """ Tests moving a user to another shard """
+
+        res = self.client.put('/api/admin/users/1/shard', headers={ "X-Admin-Token": "unittest" }, data=dumps({ "shard": 3 }), content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        self.assertIs(shards.for_user(1), shards.shards[3])
+
+    def test_move_user_nonexistent_shard(self):
+        """ Tests moving a user to a shard that doesnt exists """
+
+        res = self.client.put('/api/admin/users/1/shard', headers={ "X-Admin-Token": "unittest" }, data=dumps({ "shard": 9 }), content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_move_user_invalid_shard(self):
+        """ Tests moving a user to a shard that is not an integer """
+
+        for shard in (True, 1.9, "-1"):
+            res = self.client.put('/api/admin/users/1/shard', headers={ "X-Admin-Token": "unittest" }, data=dumps({ "shard": shard }), content_type='application/json')
+            self.assertEqual(res.status_code, 400)
+
+    def test_move_nonexistent_user(self):
+        """ Tests moving a user that doesnt exists """
+
+        res = self.client.put('/api/admin/users/9/shard', headers={ "X-Admin-Token": "unittest" }, data=dumps({ "shard": 1 }), content_type='application/json')
+        self.assertEqual(res.status_code, 404)